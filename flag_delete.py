@@ -1,15 +1,79 @@
+import asyncio
+import atexit
 import configparser
 import csv
 import datetime
+import hashlib
+import itertools
 import json
 import logging
 import os
+import pickle
+import queue
 import sys
+import threading
+from collections import deque, namedtuple
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from py_jama_rest_client.client import JamaClient, APIException
 
+try:
+    # orjson parses and serializes several times faster than the stdlib json module. it is
+    # an optional dependency, anything json-shaped goes through the helpers below so the
+    # stdlib quietly takes over when orjson is not installed.
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # aiohttp backs the optional use_asyncio execution path. at high concurrency a single
+    # event loop multiplexes every request without per-thread stacks or GIL handoffs; when
+    # it is not installed the script simply stays on the threaded pipeline.
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 logger = logging.getLogger(__name__)
 
+# one parsed CSV row. a namedtuple costs a fraction of the memory of the dict it replaces,
+# which adds up across the in-flight window on multi-million row files.
+CsvRow = namedtuple('CsvRow', ['row', 'id'])
+
+
+def json_loads(json_string):
+    if orjson is not None:
+        return orjson.loads(json_string)
+    return json.loads(json_string)
+
+
+def json_dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data).decode()
+    return json.dumps(data)
+
+
+@dataclass(frozen=True)
+class Settings:
+    # every config value the script needs, extracted once at startup. configparser lookups
+    # do case-insensitive section/option handling on every call, so the rest of the script
+    # reads plain attributes off this object instead of going back through the parser.
+    jama_connect_url: str
+    oauth: bool
+    user_id: str
+    user_secret: str
+    csv_file: str
+    csv_using_header: bool
+    csv_header_value: str
+    deleted_flag_field_map: dict
+    fetch_workers: int
+    fetch_batch_size: int
+    use_asyncio: bool
+
 
 def init_logging():
     try:
@@ -18,8 +82,25 @@ def init_logging():
         pass
     current_date_time = datetime.datetime.now().strftime("%Y-%m-%d %H_%M_%S")
     log_file = 'logs/dox_importer_' + str(current_date_time) + '.log'
-    logging.basicConfig(filename=log_file, level=logging.INFO)
-    logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+    # route every record through a queue: the worker threads only enqueue, and a single
+    # background thread does the formatting and the file/stdout writes. logging's handler
+    # lock would otherwise be a contended critical section once the pools are busy.
+    log_queue = queue.Queue(-1)
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(QueueHandler(log_queue))
+    # keep the LEVEL:name: line prefix that basicConfig used to apply, the severity prefix
+    # is what distinguishes errors from info lines in the log file
+    formatter = logging.Formatter(logging.BASIC_FORMAT)
+    file_handler = logging.FileHandler(log_file)
+    file_handler.setFormatter(formatter)
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(formatter)
+    listener = QueueListener(log_queue, file_handler, stream_handler)
+    listener.start()
+    # flush and stop the listener thread on process exit, including the exit(1) error
+    # paths, so no queued records get dropped
+    atexit.register(listener.stop)
 
 
 def parse_config():
@@ -37,6 +118,23 @@ def parse_config():
         if not os.path.isabs(path_to_config):
             path_to_config = os.path.join(current_dir, path_to_config)
 
+    # runs scheduled over many CSVs pay the ini parse on every invocation, so keep a cached
+    # copy of the parsed sections keyed by the file's content hash. any problem with the
+    # cache just falls through to a regular parse.
+    config_hash = None
+    cache_path = None
+    try:
+        with open(path_to_config, 'rb') as raw_config_file:
+            config_hash = hashlib.sha256(raw_config_file.read()).hexdigest()
+        cache_path = os.path.join(os.path.expanduser('~'), '.cache', 'flag-item-delete', config_hash + '.pkl')
+        with open(cache_path, 'rb') as cache_file:
+            cached_sections = pickle.load(cache_file)
+        configuration = configparser.ConfigParser()
+        configuration.read_dict(cached_sections)
+        return configuration
+    except Exception:
+        pass
+
     # Parse config file.
     configuration = configparser.ConfigParser()
     try:
@@ -46,49 +144,45 @@ def parse_config():
         logger.error("Unable to parse configuration file. exception: " + str(e))
         exit(1)
 
+    # write through so the next run against an unchanged config skips the parse entirely.
+    # the pickle carries the CLIENT_SETTINGS credentials, so the cache directory and file
+    # are created readable by the operator only instead of the default umask permissions.
+    if cache_path is not None:
+        try:
+            os.makedirs(os.path.dirname(cache_path), mode=0o700, exist_ok=True)
+            cache_fd = os.open(cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(cache_fd, 'wb') as cache_file:
+                pickle.dump({section: dict(configuration[section]) for section in configuration.sections()},
+                            cache_file)
+        except Exception:
+            pass
+
     return configuration
 
 
-def create_jama_client(config):
-    global instance_url
-    url = None
-    user_id = None
-    user_secret = None
-    oauth = None
+def load_settings(configuration):
+    # pull every value the script needs out of the parsed config up front and hand back a
+    # single frozen Settings object, validating as we go.
     try:
-        url = config['CLIENT_SETTINGS']['jama_connect_url']
-        # Clean up the URL field
-        while url.endswith('/') and url != 'https://' and url != 'http://':
-            url = url[0:len(url) - 1]
-        # If http or https method not specified in the url then add it now.
-        if not (url.startswith('https://') or url.startswith('http://')):
-            url = 'https://' + url
-        oauth = config.getboolean('CLIENT_SETTINGS', 'oauth')
-        user_id = config.get('CLIENT_SETTINGS', 'user_id').strip()
-        user_secret = config.get('CLIENT_SETTINGS', 'user_secret').strip()
-        instance_url = url
+        url = configuration['CLIENT_SETTINGS']['jama_connect_url']
+        oauth = configuration.getboolean('CLIENT_SETTINGS', 'oauth')
+        user_id = configuration.get('CLIENT_SETTINGS', 'user_id').strip()
+        user_secret = configuration.get('CLIENT_SETTINGS', 'user_secret').strip()
     except configparser.Error as config_error:
         logger.error("Unable to parse CLIENT_SETTINGS from config file because: {}, "
                      "Please check config file for errors and try again."
                      .format(str(config_error)))
         exit(1)
 
-    return JamaClient(url, (user_id, user_secret), oauth=oauth)
-
-
-def process_csv():
-    csv_content = []
-    csv_lines_read = 0
-
     # get the CSV script params from the config file
     csv_file = ''
     csv_using_header = True
     csv_header_value = ''
     try:
-        csv_file = conf['SCRIPT_PARAMETERS']['csv_file_path']
-        csv_using_header = conf.getboolean('SCRIPT_PARAMETERS', 'csv_using_header')
+        csv_file = configuration['SCRIPT_PARAMETERS']['csv_file_path']
+        csv_using_header = configuration.getboolean('SCRIPT_PARAMETERS', 'csv_using_header')
         if csv_using_header:
-            csv_header_value = conf.get('SCRIPT_PARAMETERS', 'csv_header_value').strip()
+            csv_header_value = configuration.get('SCRIPT_PARAMETERS', 'csv_header_value').strip()
     except Exception as e:
         logger.error(
             'unable to retrieve required script parameters csv_using_header/csv_header_value. e:{}'.format(str(e)))
@@ -102,34 +196,407 @@ def process_csv():
         logger.error('missing required script param csv_file_path')
         exit(1)
 
-    # Open the CSV file for reading, use the utf-8-sig encoding to deal with excel file type outputs.
-    with open(str(csv_file), encoding='utf-8-sig') as open_csv_file:
-        # We need to get a dict reader, if the CSV file has headers, we dont need to supply them
-        csv_dict_reader = csv.DictReader(open_csv_file)
+    # get the delete flag field map from the config
+    deleted_flag_field_map = {}
+    try:
+        json_string = configuration.get('SCRIPT_PARAMETERS', 'deleted_flag_field_map')
+        deleted_flag_field_map = json_loads(json_string)
+    except Exception as e:
+        logger.error('unable to parse out deleted_flag_field_map from the config.ini, e:{}'.format(str(e)))
 
-        # validate that we have a valid username column
-        if csv_using_header and csv_header_value not in csv_dict_reader.fieldnames:
-            logger.error('unable to find the identifier column{} in the CSV file. script exiting...')
-            exit(1)
+    return Settings(
+        jama_connect_url=url,
+        oauth=oauth,
+        user_id=user_id,
+        user_secret=user_secret,
+        csv_file=csv_file,
+        csv_using_header=csv_using_header,
+        csv_header_value=csv_header_value,
+        deleted_flag_field_map=deleted_flag_field_map,
+        fetch_workers=configuration.getint('SCRIPT_PARAMETERS', 'fetch_workers', fallback=16),
+        fetch_batch_size=configuration.getint('SCRIPT_PARAMETERS', 'fetch_batch_size', fallback=20),
+        use_asyncio=configuration.getboolean('SCRIPT_PARAMETERS', 'use_asyncio', fallback=False),
+    )
+
+
+def clean_instance_url(raw_url):
+    # Clean up the URL field, one rstrip call instead of peeling a slash per loop pass
+    url = raw_url.rstrip('/')
+    # a bare scheme loses its slashes to the strip, put them back
+    if url == 'https:' or url == 'http:':
+        url += '//'
+    # If http or https method not specified in the url then add it now.
+    if not (url.startswith('https://') or url.startswith('http://')):
+        url = 'https://' + url
+    return url
+
+
+def create_jama_client(settings):
+    url = clean_instance_url(settings.jama_connect_url)
+    return JamaClient(url, (settings.user_id, settings.user_secret), oauth=settings.oauth)
+
+
+def tune_client_session(client, pool_size):
+    # grow the connection pool on the client's underlying requests session to match our worker
+    # count, otherwise threads serialize on urllib3's default pool of 10 connections.
+    # these attributes are name mangled inside py_jama_rest_client so fall back gracefully
+    # if the library layout ever changes.
+    core = getattr(client, '_JamaClient__core', None)
+    session = getattr(core, '_Core__session', None)
+    if session is None:
+        logger.warning('unable to locate the underlying requests session, leaving the default connection pool size')
+        return
+    # retry throttled or transient server failures with a small backoff. the GETs and the
+    # flag PATCHes are both idempotent so retrying either is safe. raise_on_status=False
+    # hands the final 4xx/5xx response back to py_jama_rest_client once retries are
+    # exhausted, so failures still surface as APIException for the workers to catch
+    # instead of a RetryError that would abort the whole run.
+    retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                    allowed_methods=frozenset(['GET', 'PATCH']), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    # the fetch phase is dominated by bytes moved off the wire (abstractitems has no field
+    # projection parameter, every custom field comes back on every item), so make sure the
+    # responses at least travel compressed. requests asks for gzip by default but be explicit,
+    # and warn once if the server ignores it.
+    session.headers.setdefault('Accept-Encoding', 'gzip, deflate')
+    session.hooks.setdefault('response', []).append(warn_if_uncompressed)
+
+
+def warn_if_uncompressed(response, **kwargs):
+    # response hook, logs a single warning if the server is not compressing its responses
+    global compression_checked
+    if compression_checked:
+        return
+    compression_checked = True
+    if not response.headers.get('Content-Encoding'):
+        logger.warning('server responses are not compressed, transfer sizes will be larger than necessary')
+
+
+compression_checked = False
+
+
+# memoized get_abstract_items results keyed by identifier, shared across the fetch pool so a
+# repeated identifier never costs a second round trip.
+fetch_cache = {}
+fetch_cache_lock = threading.Lock()
+
+
+def fetch_item(client, csv_item):
+    # worker body for the fetch pool. returns the csv item paired with either the list of
+    # matched items or the APIException, so the main thread can log results in order.
+    identifier = csv_item.id
+    with fetch_cache_lock:
+        if identifier in fetch_cache:
+            return csv_item, fetch_cache[identifier]
+    try:
+        fetched_items = client.get_abstract_items(contains=identifier)
+    except APIException as e:
+        return csv_item, e
+    with fetch_cache_lock:
+        fetch_cache[identifier] = fetched_items
+    return csv_item, fetched_items
+
+
+def fetch_batch(client, csv_batch):
+    # worker body for the fetch pool. running a batch of lookups on one worker keeps them on
+    # the same pooled keep-alive connection and amortizes the task submission overhead.
+    # note the Jama API cannot collapse a batch into a single request: multiple contains
+    # values on /abstractitems are ANDed together, so each identifier still needs its own
+    # round trip.
+    return [fetch_item(client, csv_row) for csv_row in csv_batch]
+
+
+def iter_batches(iterable, batch_size):
+    # yield lists of up to batch_size elements without consuming the whole iterable
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def iter_fetch_results(client, csv_rows, fetch_pool, max_in_flight, batch_size):
+    # submit batches of lookups to the fetch pool while reading the CSV, keeping a bounded
+    # number in flight, and yield the completed results in submission order. this overlaps
+    # the CSV parse with the network round trips while holding only
+    # O(max_in_flight * batch_size) rows in memory.
+    pending = deque()
+    for csv_batch in iter_batches(csv_rows, batch_size):
+        pending.append(fetch_pool.submit(fetch_batch, client, csv_batch))
+        if len(pending) >= max_in_flight:
+            for fetch_result in pending.popleft().result():
+                yield fetch_result
+    while pending:
+        for fetch_result in pending.popleft().result():
+            yield fetch_result
+
+
+def plan_update(item, delete_field_names):
+    # decide whether a fetched item still needs its delete flag set. returns the
+    # (item id, field name) tuple to patch, or None when the item should be skipped.
+    # get the field from the prebuilt delete field map, which also validates that the
+    # mapping has the current item type
+    item_type_id = str(item['itemType'])
+    delete_field_name = delete_field_names.get(item_type_id)
+    if delete_field_name is None:
+        logger.error(
+            'itemtype ID:{} is missing from the config.ini deleted_flag_field_map. skipping item...'.format(
+                item_type_id))
+        return None
+
+    # validate that the fields payload has the delete field
+    item_fields = item['fields']
+    if delete_field_name not in item_fields:
+        logger.error('item does not have the field: {}. skipping item...'.format(delete_field_name))
+        return None
+
+    # we only need to update this item if its currently set to False.
+    if item_fields[delete_field_name]:
+        logger.info('item ID:{} already flagged for delete skipping item...'.format(item['id']))
+        return None
+
+    return item['id'], delete_field_name
+
+
+def hash_csv_file(csv_file):
+    # stream the file through sha256 in 1 MiB chunks so hashing never loads the whole file
+    digest = hashlib.sha256()
+    with open(csv_file, 'rb') as raw_file:
+        for chunk in iter(lambda: raw_file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_checkpoint(csv_file):
+    # identifiers already patched by a previous run against this exact CSV content. the
+    # state file is keyed by the file's content hash, so only a byte-for-byte unchanged
+    # file resumes from the checkpoint; any edit to the CSV starts fresh.
+    state_path = os.path.join('logs', 'state_{}.json'.format(hash_csv_file(csv_file)))
+    done_identifiers = set()
+    try:
+        with open(state_path) as state_file:
+            done_identifiers = set(json_loads(state_file.read()))
+    except Exception:
+        pass
+    return state_path, done_identifiers
 
-        # Begin processing the data in the CSV file.
-        for row_number, row_data in enumerate(csv_dict_reader):
-            # For each row in the CSV file we will append an object to a list for later processing.
-            # First get source and target data. These are mandatory, a missing data point here is an error.
-            csv_lines_read += 1
 
-            # run some quick validations that we have data in the cells
-            current_row_rel_data = {
-                'row': row_number + 1 if csv_using_header else row_number,
-                'id': row_data[csv_header_value] if csv_using_header else json.dumps(row_data),
-            }
-            csv_content.append(current_row_rel_data)
+def save_checkpoint(state_path, done_identifiers):
+    # persist the patched identifiers, called after every successful PATCH so a crashed or
+    # interrupted run loses at most the updates still in flight. never fatal, the worst
+    # case is re-checking items whose flag is already set.
+    try:
+        with open(state_path, 'w') as state_file:
+            state_file.write(json_dumps(sorted(done_identifiers)))
+    except Exception:
+        pass
+
+
+def evaluate_fetch_result(csv_item, result, delete_field_names):
+    # shared by the threaded and asyncio paths: log the outcome of one lookup and return
+    # the planned update, or None when the row should be skipped.
+    if isinstance(result, Exception):
+        logger.error(
+            '    ERROR unable to retrieve items for csv entry: {} with error: {}, skipping item...'.format(str(csv_item),
+                                                                                                 str(result)))
+        return None
+
+    # we MUST have only one match here to continue
+    if len(result) == 0:
+        logger.error('    ERROR found zero matches for csv entry: {}. skipping item...'.format(str(csv_item)))
+        return None
+    # more than one match found
+    elif len(result) > 1:
+        logger.error('   ERROR found multiple matches for csv entry: {}. skipping item...'.format(str(csv_item)))
+        return None
+
+    # exactly one match found, check to see if we need to update the item.
+    # this work might already be done.
+    logger.info('    found match to corresponding Jama ID: {}'.format(result[0].get('id')))
+    update_item = plan_update(result[0], delete_field_names)
+    if update_item is None:
+        return None
+    # carry the CSV identifier along so a successful PATCH can be checkpointed against it
+    return update_item + (csv_item.id,)
+
+
+def log_patch_result(item_id, error):
+    # report one completed PATCH, returns True when the update succeeded
+    if error is not None:
+        logger.error('unable to update item ID:{} exception:{}'.format(item_id, str(error)))
+        return False
+    logger.info('successfully updated item id:{} to be flagged for delete'.format(item_id))
+    return True
+
+
+def patch_batch(client, update_items):
+    # worker body for the update pool. the Jama REST API has no bulk item-update endpoint,
+    # every flag flip is its own PATCH against /items/{id}, so batching here serves the same
+    # purpose as on the fetch side: one worker runs its whole batch over the same pooled
+    # keep-alive connection and the task submission overhead is amortized across the batch.
+    return [patch_item_flag(client, update_item) for update_item in update_items]
+
+
+def patch_item_flag(client, update_item):
+    # worker body for the update pool. builds the patch payload and flips the mapped delete
+    # flag, returning the update item paired with the APIException on failure or None on success.
+    patch_payload = {
+        'op': 'replace',
+        'path': '/fields/' + update_item[1],
+        'value': True
+    }
+    try:
+        client.patch_item(update_item[0], patch_payload)
+    except APIException as e:
+        return update_item, e
+    return update_item, None
+
+
+async def fetch_item_async(session, semaphore, base_url, csv_item):
+    # async counterpart of fetch_item: one GET per identifier, throttled by the semaphore.
+    # aiohttp raises asyncio.TimeoutError (not a ClientError) when its total timeout
+    # expires, catch it too so one slow request skips its row instead of killing the
+    # gather. note the threaded path additionally retries 429/5xx at the session level,
+    # the async path has no such retry and reports those failures straight away.
+    async with semaphore:
+        try:
+            async with session.get(base_url + '/rest/v1/abstractitems',
+                                   params={'contains': csv_item.id}) as response:
+                response.raise_for_status()
+                payload = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return csv_item, e
+    return csv_item, payload.get('data', [])
+
+
+async def patch_item_flag_async(session, semaphore, base_url, update_item):
+    # async counterpart of patch_item_flag, sends the same single-op payload
+    patch_payload = {
+        'op': 'replace',
+        'path': '/fields/' + update_item[1],
+        'value': True
+    }
+    async with semaphore:
+        try:
+            async with session.patch(base_url + '/rest/v1/items/' + str(update_item[0]),
+                                     json=patch_payload) as response:
+                response.raise_for_status()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return update_item, e
+    return update_item, None
+
+
+async def run_async_pipeline(settings, base_url, delete_field_names, state_path, done_identifiers):
+    # event loop variant of the fetch/update flow, enabled with use_asyncio in the config.
+    # every request is multiplexed on one loop with concurrency capped by a semaphore.
+    # unlike the threaded pipeline this reads all rows up front, asyncio.gather keeps the
+    # result order aligned with the CSV so the log output matches the threaded path.
+    fetch_counter = 0
+    update_counter = 0
+    updated_count = 0
+    skipped_counter = 0
+
+    concurrency = settings.fetch_workers * 2
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=concurrency)
+    auth = aiohttp.BasicAuth(settings.user_id, settings.user_secret)
+    async with aiohttp.ClientSession(auth=auth, connector=connector) as session:
+        fetch_tasks = [fetch_item_async(session, semaphore, base_url, csv_item)
+                       for csv_item in iter_csv_rows(settings, done_identifiers)]
+        update_list = []
+        for csv_item, result in await asyncio.gather(*fetch_tasks):
+            fetch_counter += 1
+            logger.info('{} - processing item with identifier:{} ...'.format(fetch_counter, csv_item.id))
+            update_item = evaluate_fetch_result(csv_item, result, delete_field_names)
+            if update_item is None:
+                skipped_counter += 1
+                continue
+            update_counter += 1
+            update_list.append(update_item)
+
+        patch_tasks = [patch_item_flag_async(session, semaphore, base_url, update_item)
+                       for update_item in update_list]
+        for update_item, error in await asyncio.gather(*patch_tasks):
+            if log_patch_result(update_item[0], error):
+                updated_count += 1
+                done_identifiers.add(update_item[2])
+                save_checkpoint(state_path, done_identifiers)
+
+    logger.info('Processed {} rows: identified {} items to be flagged for delete, '
+                'successfully updated {}, skipped {}'.format(fetch_counter, update_counter,
+                                                             updated_count, skipped_counter))
+
 
+def iter_csv_rows(settings, skip_identifiers=frozenset()):
+    csv_lines_read = 0
+    duplicate_count = 0
+    already_done_count = 0
+    seen_identifiers = set()
+
+    csv_file = settings.csv_file
+    csv_using_header = settings.csv_using_header
+    csv_header_value = settings.csv_header_value
+
+    # Open the CSV file for reading, use the utf-8-sig encoding to deal with excel file type
+    # outputs. newline='' hands newline handling to the csv module as its docs require, which
+    # also keeps embedded newlines inside quoted cells intact, and the 1 MiB buffer lets the
+    # reader scan large files in far fewer read calls than the 8 KB default.
+    with open(csv_file, encoding='utf-8-sig', newline='', buffering=1 << 20) as open_csv_file:
+        # a plain csv.reader hands back one list per row, only the identifier column is ever
+        # read so there is no need for DictReader to build a dict keyed by every header.
+        csv_reader = csv.reader(open_csv_file)
+
+        # resolve the identifier column position once from the header row
+        identifier_index = 0
+        if csv_using_header:
+            header_row = next(csv_reader, [])
+            # validate that we have a valid identifier column
+            if csv_header_value not in header_row:
+                logger.error('unable to find the identifier column{} in the CSV file. script exiting...')
+                exit(1)
+            identifier_index = header_row.index(csv_header_value)
+
+        # Begin processing the data in the CSV file. the header flag is fixed for the whole
+        # file, so choose the row numbering and the identifier extraction once up front
+        # instead of re-evaluating both conditionals on every row.
+        if csv_using_header:
+            numbered_rows = ((row_number, row_data[identifier_index])
+                             for row_number, row_data in enumerate(csv_reader, start=1))
+        else:
+            numbered_rows = ((row_number, json_dumps(row_data))
+                             for row_number, row_data in enumerate(csv_reader))
+
+        # each row is yielded downstream for processing one at a time, so arbitrarily large
+        # files never get materialized in memory.
+        for row_number, identifier in numbered_rows:
+            csv_lines_read += 1
+
+            # identifiers already patched by a previous run against the same CSV content
+            # have nothing left to do.
+            if identifier in skip_identifiers:
+                already_done_count += 1
+                continue
+
+            # a repeated identifier would fetch (and later patch) the exact same item again,
+            # so only the first occurrence of each identifier flows downstream.
+            if identifier in seen_identifiers:
+                duplicate_count += 1
+                continue
+            seen_identifiers.add(identifier)
+            yield CsvRow(row=row_number, id=identifier)
+
+    if already_done_count:
+        logger.info('skipped {} identifiers already patched by a previous run'.format(already_done_count))
+    if duplicate_count:
+        logger.info('dropped {} duplicate identifiers from the CSV content'.format(duplicate_count))
     logger.info('Successfully processed {} CSV rows. from file {}'.format(str(csv_lines_read), csv_file))
-    return csv_content
 
 
-if __name__ == "__main__":
+def main():
 
     #  high level script logic:
     #
@@ -141,97 +608,102 @@ if __name__ == "__main__":
     # Setup logging
     init_logging()
 
-    # Get Config File Path
+    # Get Config File Path and extract all settings from it
     conf = parse_config()
+    settings = load_settings(conf)
+
+    # format the delete fields once up front to be: fieldName $ itemTypeId (custom field),
+    # so the per-item scan is a single dict lookup instead of a string format per item.
+    delete_field_names = {item_type_id: '{}${}'.format(field_name, item_type_id)
+                          for item_type_id, field_name in settings.deleted_flag_field_map.items()}
+
+    # load the checkpoint of identifiers already patched against this exact CSV content, a
+    # rerun over an unchanged file only redoes the rows that did not finish last time
+    state_path, done_identifiers = load_checkpoint(settings.csv_file)
+    if done_identifiers:
+        logger.info('checkpoint found: {} identifiers were already patched by a previous run'.format(
+            len(done_identifiers)))
+
+    # optional event loop execution path, see run_async_pipeline. the OAuth token flow
+    # lives inside py_jama_rest_client so the async path only covers basic authentication.
+    if settings.use_asyncio:
+        if aiohttp is None:
+            logger.warning('use_asyncio is enabled but aiohttp is not installed, falling back to threaded execution')
+        elif settings.oauth:
+            logger.warning('use_asyncio only supports basic authentication, falling back to threaded execution')
+        else:
+            asyncio.run(run_async_pipeline(settings, clean_instance_url(settings.jama_connect_url),
+                                           delete_field_names, state_path, done_identifiers))
+            logger.info('Script Complete')
+            return
 
     # Create Jama Client
-    jama_client = create_jama_client(conf)
+    jama_client = create_jama_client(settings)
 
-    # get the delete flag field map from the config
-    deleted_flag_field_map = {}
-    try:
-        json_string = conf.get('SCRIPT_PARAMETERS', 'deleted_flag_field_map')
-        deleted_flag_field_map = json.loads(json_string)
-    except Exception as e:
-        logger.error('unable to parse out deleted_flag_field_map from the config.ini, e:{}'.format(str(e)))
+    # the fetch and update phases are network bound, size the pools and the client's
+    # connection pool from the configured worker count.
+    fetch_workers = settings.fetch_workers
+    fetch_batch_size = settings.fetch_batch_size
+    # the fetch and patch pools run concurrently against the same session, so size the
+    # connection pool for their combined worker count. a warm connection is reused across
+    # requests, saving the TCP+TLS handshake on everything after the first round trip.
+    tune_client_session(jama_client, fetch_workers * 2)
 
-    # process the csv content
-    csv_items = process_csv()
-    item_list = []
     fetch_counter = 0
-    for csv_item in csv_items:
-        fetch_counter += 1
-        fetched_items = []
-        try:
-            logger.info('{}/{} processing item with identifier:{} ...'.format(fetch_counter, len(csv_items),
-                                                                                         csv_item.get('id')))
-            fetched_items = jama_client.get_abstract_items(contains=csv_item.get('id'))
-        except APIException as e:
-            logger.error(
-                '    ERROR unable to retrieve items for csv entry: {} with error: {}, skipping item...'.format(str(csv_item),
-                                                                                                     str(e)))
-            break
-
-        # we MUST have only one match here to continue
-        if len(fetched_items) == 0:
-            logger.error('    ERROR found zero matches for csv entry: {}. skipping item...'.format(str(csv_item)))
-            break
-        # more than one match found
-        elif len(fetched_items) > 1:
-            logger.error('   ERROR found multiple matches for csv entry: {}. skipping item...'.format(str(csv_item)))
-            break
-        # otherwise this exactly one match found
-        else:
-            # save this item to the item list
-            item_list.append(fetched_items[0])
-            logger.info('    found match to corresponding Jama ID: {}'.format(fetched_items[0].get('id')))
-
-    # loop over the item list and check to see if we need to update the item
-    # this work might already be done.
-    update_list = []
-    item_counter = 0
-    for item in item_list:
-        item_counter += 1
-        # get the field from the delete field map
-        item_type_id = str(item.get('itemType'))
-        # validate that the mapping has the current item type
-        if item_type_id not in deleted_flag_field_map:
-            logger.error(
-                'itemtype ID:{} is missing from the config.ini deleted_flag_field_map. skipping item...'.format(
-                    item_type_id))
-            break
-
-        # format the delete field to be: fieldName $ itemTypeId (custom field)
-        delete_field_name = '{}${}'.format(deleted_flag_field_map.get(item_type_id), item_type_id)
-
-        # validate that the fields payload has the delete field
-        if delete_field_name not in item.get('fields'):
-            logger.error('item does not have the field: {}. skipping item...'.format(delete_field_name))
-            break
-
-        # we only need to update this item if its currently set to False.
-        if not item.get('fields').get(delete_field_name):
-            update_list.append((item.get('id'), delete_field_name))
-        else:
-            logger.info('item ID:{} already flagged for delete skipping item...'.format(item.get('id')))
-
-    logger.info('Identified {} items to be flagged for delete'.format(len(update_list)))
     update_counter = 0
-
-    # iterate over the update list and update each item
-    for update_item in update_list:
-        try:
+    updated_count = 0
+    skipped_counter = 0
+    # allow a little headroom over the worker count so the pools never sit idle waiting on
+    # the main thread, while still bounding how many rows/results are held in memory.
+    max_in_flight = fetch_workers * 2
+
+    # run the whole thing as a streaming pipeline: CSV rows are read one at a time, lookups
+    # start before the file is fully parsed, and each PATCH is submitted as soon as its
+    # lookup passes the match/type/field checks. peak memory stays O(max_in_flight) rows
+    # instead of holding the full item and update lists.
+    with ThreadPoolExecutor(max_workers=fetch_workers) as fetch_pool, \
+            ThreadPoolExecutor(max_workers=fetch_workers) as patch_pool:
+        pending_patches = deque()
+        update_buffer = []
+        for csv_item, result in iter_fetch_results(jama_client, iter_csv_rows(settings, done_identifiers),
+                                                   fetch_pool, max_in_flight, fetch_batch_size):
+            fetch_counter += 1
+            logger.info('{} - processing item with identifier:{} ...'.format(fetch_counter, csv_item.id))
+            update_item = evaluate_fetch_result(csv_item, result, delete_field_names)
+            if update_item is None:
+                skipped_counter += 1
+                continue
+
+            # buffer planned updates into the same sized batches as the fetch side before
+            # handing them to the update pool
             update_counter += 1
-            patch_payload = {
-                'op': 'replace',
-                'path': '/fields/' + update_item[1],
-                'value': True
-            }
-            jama_client.patch_item(update_item[0], patch_payload)
-            logger.info('item {}/{} - successfully updated item id:{} to be flagged for delete'.format(update_counter,
-                                                                                                       len(update_list),
-                                                                                                       update_item[0]))
-        except APIException as e:
-            logger.error('unable to update item ID:{} exception:{}'.format(update_item[0], str(e)))
+            update_buffer.append(update_item)
+            if len(update_buffer) >= fetch_batch_size:
+                pending_patches.append(patch_pool.submit(patch_batch, jama_client, update_buffer))
+                update_buffer = []
+            if len(pending_patches) >= max_in_flight:
+                for update_item, error in pending_patches.popleft().result():
+                    if log_patch_result(update_item[0], error):
+                        updated_count += 1
+                        done_identifiers.add(update_item[2])
+                        save_checkpoint(state_path, done_identifiers)
+
+        # flush the partial batch and drain whatever updates are still in flight
+        if update_buffer:
+            pending_patches.append(patch_pool.submit(patch_batch, jama_client, update_buffer))
+        while pending_patches:
+            for update_item, error in pending_patches.popleft().result():
+                if log_patch_result(update_item[0], error):
+                    updated_count += 1
+                    done_identifiers.add(update_item[2])
+                    save_checkpoint(state_path, done_identifiers)
+
+    logger.info('Processed {} rows: identified {} items to be flagged for delete, '
+                'successfully updated {}, skipped {}'.format(fetch_counter, update_counter,
+                                                             updated_count, skipped_counter))
 
     logger.info('Script Complete')
+
+
+if __name__ == "__main__":
+    main()